@@ -1,6 +1,28 @@
+import sys
+from copy import deepcopy
+from types import SimpleNamespace
+from typing import Any
+
 import pytest
+from openai.types import Model
+from openai.types.chat.chat_completion_chunk import (
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
 
-from unmute.llm.llm_utils import rechunk_to_words
+from unmute.llm.llm_utils import (
+    INTERRUPTION_CHAR,
+    IncrementalPreprocessor,
+    LLMResponseCache,
+    VLLMStream,
+    autoselect_model_async,
+    get_selected_model,
+    preprocess_messages_for_llm,
+    preprocess_messages_for_llm_inplace,
+    rechunk_to_words,
+    rechunk_to_words_and_functions,
+)
 
 
 async def make_iterator(s: str):
@@ -36,3 +58,390 @@ async def test_rechunk_to_words():
     assert await f(" they are ok") == [" they", " are", " ok"]
     assert await f("  foo bar") == [" foo", " bar"]
     assert await f(" \t foo  bar") == [" foo", " bar"]
+    assert await f("foo| bar  baz") == ["foo", " bar", " baz"]
+    assert await f("foo\x1cbar") == ["foo", " bar"]
+
+
+def test_preprocess_messages_for_llm_does_not_mutate_input():
+    tool_calls = [
+        {
+            "id": "call_1",
+            "type": "function",
+            "function": {"name": "f", "arguments": "{}"},
+        }
+    ]
+    chat_history = [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "hello"},
+        {"role": "user", "content": "there"},
+        {"role": "assistant", "content": None, "tool_calls": tool_calls},
+        {"role": "user", "content": "...are you there?"},
+    ]
+    snapshot = [dict(m) for m in chat_history]
+
+    output = preprocess_messages_for_llm(chat_history)
+
+    assert chat_history == snapshot
+    assert output[1] == {"role": "user", "content": "hello there"}
+    # Nested values are shared, not copied
+    assert output[2]["tool_calls"] is tool_calls
+    assert output[3] == {"role": "user", "content": "are you there?"}
+
+
+def test_incremental_preprocessor_matches_full():
+    preprocessor = IncrementalPreprocessor()
+    chat_history: list[dict[str, Any]] = [{"role": "system", "content": "Be nice."}]
+
+    def check():
+        snapshot = deepcopy(chat_history)
+        expected = preprocess_messages_for_llm(chat_history)
+        assert preprocessor(chat_history) == expected
+        assert chat_history == snapshot
+
+    check()
+    chat_history.append({"role": "assistant", "content": ""})
+    check()
+    chat_history[-1]["content"] += "Hi"
+    check()
+    chat_history[-1]["content"] += " there."
+    check()
+    chat_history.append({"role": "assistant", "content": INTERRUPTION_CHAR})
+    check()
+    chat_history.append({"role": "user", "content": "Hello"})
+    check()
+    chat_history.append({"role": "user", "content": "again"})
+    check()
+    chat_history.append({"role": "user", "content": "...are you there?"})
+    check()
+    check()
+    chat_history[0] = {"role": "system", "content": "Be mean."}
+    check()
+    del chat_history[-2:]
+    check()
+
+
+def make_delta(content: str | None = None, tool_calls: list[Any] | None = None):
+    return SimpleNamespace(content=content, tool_calls=tool_calls)
+
+
+def make_tool_call_chunk(
+    index: int, id: str | None = None, name: str | None = None, arguments: str = ""
+):
+    return SimpleNamespace(
+        index=index,
+        id=id,
+        function=SimpleNamespace(name=name, arguments=arguments),
+    )
+
+
+@pytest.mark.asyncio
+async def test_rechunk_to_words_and_functions():
+    async def deltas():
+        yield make_delta(tool_calls=[make_tool_call_chunk(0, "call_0", "f", '{"a"')])
+        yield make_delta(tool_calls=[make_tool_call_chunk(0, arguments=": 1}")])
+        yield make_delta(tool_calls=[make_tool_call_chunk(1, "call_1", "g", "{}")])
+        yield make_delta(content="hello wor")
+        yield make_delta(content="ld")
+
+    chunks = [x async for x in rechunk_to_words_and_functions(deltas())]
+
+    assert [list(c.keys())[0] for c in chunks] == [
+        "function",
+        "function",
+        "word",
+        "word",
+    ]
+    assert chunks[0]["function"].id == "call_0"
+    assert chunks[0]["function"].function.arguments == '{"a": 1}'
+    assert chunks[1]["function"].id == "call_1"
+    assert chunks[1]["function"].function.name == "g"
+    assert chunks[2] == {"word": "hello"}
+    assert chunks[3] == {"word": " world"}
+
+    async def only_tool_call():
+        yield make_delta(tool_calls=[make_tool_call_chunk(0, "call_0", "f", "{")])
+        yield make_delta(tool_calls=[make_tool_call_chunk(0, arguments="}")])
+
+    chunks = [x async for x in rechunk_to_words_and_functions(only_tool_call())]
+    assert len(chunks) == 1
+    assert chunks[0]["function"].function.arguments == "{}"
+
+
+def test_preprocess_messages_for_llm_fast_path():
+    chat_history = [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "hello"},
+        {"role": "assistant", "content": "hi"},
+    ]
+    output = preprocess_messages_for_llm(chat_history)
+    assert output == chat_history
+    assert output is not chat_history
+    assert all(a is b for a, b in zip(output, chat_history, strict=True))
+
+    # The dummy user message is still added
+    output = preprocess_messages_for_llm([chat_history[0], chat_history[2]])
+    assert [m["role"] for m in output] == ["system", "user", "assistant"]
+
+
+def test_preprocess_messages_for_llm_inplace():
+    chat_history = [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "assistant", "content": INTERRUPTION_CHAR},
+        {"role": "user", "content": "hello"},
+        {"role": "user", "content": "...there"},
+        {"role": "assistant", "content": ""},
+    ]
+    expected = preprocess_messages_for_llm(chat_history)
+
+    output = preprocess_messages_for_llm_inplace(chat_history)
+
+    assert output is chat_history
+    assert output == expected
+    assert output == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "hello there"},
+    ]
+
+
+class FakeStream:
+    def __init__(self, words: list[str], error: Exception | None = None):
+        self.words = words
+        self.error = error
+        self.n_requests = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args: Any):
+        pass
+
+    async def __aiter__(self):
+        for word in self.words:
+            delta = make_delta(content=word)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+        if self.error is not None:
+            raise self.error
+
+
+def make_fake_client(stream: FakeStream) -> Any:
+    async def create(**kwargs: Any):
+        stream.n_requests += 1
+        return stream
+
+    return SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    )
+
+
+@pytest.mark.asyncio
+async def test_vllm_stream():
+    llm = VLLMStream(
+        make_fake_client(FakeStream([str(i) for i in range(20)])), model="fake"
+    )
+    messages = [{"role": "user", "content": "count"}]
+    assert [d.content async for d in llm.chat_completion(messages)] == [
+        str(i) for i in range(20)
+    ]
+
+    # Errors from the LLM stream are raised in the consumer
+    stream = FakeStream(["1"], error=ValueError("oops"))
+    llm = VLLMStream(make_fake_client(stream), model="fake")
+    with pytest.raises(ValueError):
+        _ = [d async for d in llm.chat_completion(messages)]
+
+
+@pytest.mark.asyncio
+async def test_vllm_stream_response_cache():
+    stream = FakeStream(["hello", " world"])
+    client = make_fake_client(stream)
+    cache = LLMResponseCache(max_bytes=1000)
+    llm = VLLMStream(client, model="fake", response_cache=cache)
+
+    async def ask(content: str):
+        messages = [{"role": "user", "content": content}]
+        return [d.content async for d in llm.chat_completion(messages)]
+
+    assert await ask("hi") == ["hello", " world"]
+    assert await ask("hi") == ["hello", " world"]
+    assert stream.n_requests == 1
+    assert await ask("hi again") == ["hello", " world"]
+    assert stream.n_requests == 2
+
+
+def test_llm_response_cache_eviction():
+    cache = LLMResponseCache(max_bytes=1000)
+    cache.set("a", [make_delta(content="12345")])
+    entry_size = cache.n_bytes
+    cache.max_bytes = 2 * entry_size
+
+    cache.set("b", [make_delta(content="12345")])
+    assert cache.get("a") is not None  # "a" is now the most recently used
+    cache.set("c", [make_delta(content="12345")])
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.n_bytes == 2 * entry_size
+
+    cache.set("too_big", [make_delta(content="x" * (2 * entry_size))])
+    assert cache.get("too_big") is None
+
+
+@pytest.mark.asyncio
+async def test_llm_response_cache_real_deltas():
+    deltas = [ChoiceDelta(role="assistant", content="")]
+    deltas += [ChoiceDelta(content=f" word{i}") for i in range(1000)]
+    deltas.append(
+        ChoiceDelta(
+            tool_calls=[
+                ChoiceDeltaToolCall(
+                    index=0,
+                    id="call_1",
+                    type="function",
+                    function=ChoiceDeltaToolCallFunction(name="f", arguments='{"a"'),
+                )
+            ]
+        )
+    )
+    deltas.append(
+        ChoiceDelta(
+            tool_calls=[
+                ChoiceDeltaToolCall(
+                    index=0, function=ChoiceDeltaToolCallFunction(arguments=": 1}")
+                )
+            ]
+        )
+    )
+
+    # The budget must hold the whole response, well below what the deltas take
+    max_bytes = 100_000
+    assert sum(sys.getsizeof(d) + len(d.model_dump_json()) for d in deltas) > max_bytes
+    cache = LLMResponseCache(max_bytes=max_bytes)
+    cache.set("key", deltas)
+    assert 0 < cache.n_bytes <= max_bytes
+
+    cached = cache.get("key")
+    assert cached is not None
+    replayed = [d async for d in cache.replay(cached)]
+    assert all(isinstance(d, ChoiceDelta) for d in replayed)
+
+    async def as_iterator(items: list[ChoiceDelta]):
+        for item in items:
+            yield item
+
+    assert [c async for c in rechunk_to_words_and_functions(as_iterator(replayed))] == [
+        c async for c in rechunk_to_words_and_functions(as_iterator(deltas))
+    ]
+
+
+def test_preprocess_messages_for_llm_max_tokens_hint():
+    chat_history = [{"role": "system", "content": "s" * 40}]
+    for i in range(10):
+        chat_history.append({"role": "user", "content": f"{i}" * 40})
+        chat_history.append({"role": "assistant", "content": f"{i}" * 40})
+
+    assert preprocess_messages_for_llm(chat_history, max_tokens_hint=1000) == (
+        preprocess_messages_for_llm(chat_history)
+    )
+
+    # 21 messages of 10 tokens each: 110 tokens too many, so 128 get dropped
+    output = preprocess_messages_for_llm(chat_history, max_tokens_hint=100)
+    assert output[0] == chat_history[0]
+    assert output[1] == {"role": "user", "content": "Hello."}
+    assert output[2:] == chat_history[14:]
+
+    # The start of the conversation stays the same when a message is added
+    chat_history.append({"role": "user", "content": "x" * 40})
+    output = preprocess_messages_for_llm(chat_history, max_tokens_hint=100)
+    assert output[2:] == chat_history[14:]
+
+
+def test_preprocess_messages_for_llm_max_tokens_hint_tool_result():
+    tool_call = {
+        "id": "c1",
+        "type": "function",
+        "function": {"name": "f", "arguments": "{}"},
+    }
+    chat_history = [
+        {"role": "system", "content": "s" * 2000},
+        {"role": "user", "content": "u" * 400},
+        {"role": "assistant", "content": None, "tool_calls": [tool_call]},
+        {"role": "tool", "tool_call_id": "c1", "content": "t" * 14000},
+    ]
+
+    # Over budget, but the tool result must not lose the call that it answers
+    output = preprocess_messages_for_llm(chat_history, max_tokens_hint=4096)
+    assert output[0] == chat_history[0]
+    assert output[-2:] == chat_history[2:]
+
+
+def make_fake_models_client(base_url: str, models: list[Model]) -> Any:
+    async def list_models():
+        client.n_requests += 1
+        return SimpleNamespace(data=models)
+
+    client = SimpleNamespace(
+        base_url=base_url, models=SimpleNamespace(list=list_models), n_requests=0
+    )
+    return client
+
+
+FAKE_MODELS = [
+    Model(id="b", created=1, object="model", owned_by="test"),
+    Model(id="c", created=3, object="model", owned_by="test"),
+    Model(id="a", created=2, object="model", owned_by="test"),
+]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "selector,expected", [("oldest", "b"), ("newest", "c"), ("alphabetical", "a")]
+)
+async def test_autoselect_model_async(
+    monkeypatch: pytest.MonkeyPatch, selector: str, expected: str
+):
+    monkeypatch.setattr("unmute.llm.llm_utils.KYUTAI_LLM_MODEL", None)
+    monkeypatch.setattr("unmute.llm.llm_utils.KYUTAI_LLM_MODEL_SELECTOR", selector)
+
+    client = make_fake_models_client(f"http://{selector}/v1/", FAKE_MODELS)
+    assert await autoselect_model_async(client) == expected
+    # The result is cached per server, so the models are only listed once
+    assert await autoselect_model_async(client) == expected
+    assert client.n_requests == 1
+
+    other_client = make_fake_models_client(f"http://{selector}-2/v1/", FAKE_MODELS[:1])
+    assert await autoselect_model_async(other_client) == "b"
+
+
+@pytest.mark.asyncio
+async def test_autoselect_model_async_no_models(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("unmute.llm.llm_utils.KYUTAI_LLM_MODEL", None)
+
+    with pytest.raises(ValueError, match="No models"):
+        await autoselect_model_async(make_fake_models_client("http://empty/v1/", []))
+
+
+@pytest.mark.asyncio
+async def test_vllm_stream_lazy_model_lookup(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("unmute.llm.llm_utils.KYUTAI_LLM_MODEL", None)
+    monkeypatch.setattr("unmute.llm.llm_utils.KYUTAI_LLM_MODEL_SELECTOR", "oldest")
+
+    client = make_fake_models_client("http://lazy/v1/", FAKE_MODELS)
+    requested_models: list[str] = []
+
+    async def create(**kwargs: Any):
+        requested_models.append(kwargs["model"])
+        return FakeStream(["hi"])
+
+    client.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+    llm = VLLMStream(client)
+    # Nothing is looked up before the first request
+    assert client.n_requests == 0
+    assert get_selected_model("http://lazy") is None
+
+    messages = [{"role": "user", "content": "hi"}]
+    for _ in range(2):
+        assert [d.content async for d in llm.chat_completion(messages)] == ["hi"]
+    assert requested_models == ["b", "b"]
+    assert client.n_requests == 1
+    assert get_selected_model("http://lazy") == "b"
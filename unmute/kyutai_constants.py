@@ -10,6 +10,21 @@ STT_SERVER = http_to_ws(os.environ.get("KYUTAI_STT_URL", "ws://localhost:8090"))
 TTS_SERVER = http_to_ws(os.environ.get("KYUTAI_TTS_URL", "ws://localhost:8089"))
 LLM_SERVER = os.environ.get("KYUTAI_LLM_URL", "http://localhost:8091")
 KYUTAI_LLM_MODEL = os.environ.get("KYUTAI_LLM_MODEL")
+# If KYUTAI_LLM_MODEL is not set and the LLM server has several models, which one to
+# use: "oldest", "newest" (by creation time) or "alphabetical"
+KYUTAI_LLM_MODEL_SELECTOR = os.environ.get("KYUTAI_LLM_MODEL_SELECTOR", "oldest")
+if KYUTAI_LLM_MODEL_SELECTOR not in ("oldest", "newest", "alphabetical"):
+    raise ValueError(
+        f"Unknown KYUTAI_LLM_MODEL_SELECTOR: {KYUTAI_LLM_MODEL_SELECTOR!r}, "
+        "expected 'oldest', 'newest' or 'alphabetical'."
+    )
+# Cache identical LLM requests in memory, up to this many megabytes. 0 to disable.
+# Note this makes responses to identical conversations deterministic.
+LLM_RESPONSE_CACHE_MB = float(os.environ.get("KYUTAI_LLM_RESPONSE_CACHE_MB", "0"))
+# If set, the oldest messages are dropped to keep LLM prompts under roughly this many
+# tokens
+_llm_max_prompt_tokens = os.environ.get("KYUTAI_LLM_MAX_PROMPT_TOKENS")
+LLM_MAX_PROMPT_TOKENS = int(_llm_max_prompt_tokens) if _llm_max_prompt_tokens else None
 VOICE_CLONING_SERVER = os.environ.get(
     "KYUTAI_VOICE_CLONING_URL", "http://localhost:8092"
 )
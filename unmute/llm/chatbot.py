@@ -1,7 +1,8 @@
 from logging import getLogger
 from typing import Any, Literal
 
-from unmute.llm.llm_utils import preprocess_messages_for_llm
+from unmute.kyutai_constants import LLM_MAX_PROMPT_TOKENS
+from unmute.llm.llm_utils import IncrementalPreprocessor
 from unmute.llm.system_prompt import ConstantInstructions, Instructions
 
 ConversationState = Literal["waiting_for_user", "user_speaking", "bot_speaking"]
@@ -19,6 +20,9 @@ class Chatbot:
         self._instructions: Instructions | None = None
         self.tools: list[dict[str, Any]] | None = None
         self.tool_choice: str | None = None
+        self._preprocessor = IncrementalPreprocessor(
+            max_tokens_hint=LLM_MAX_PROMPT_TOKENS
+        )
 
     def conversation_state(self) -> ConversationState:
         if not self.chat_history:
@@ -92,7 +96,7 @@ class Chatbot:
                 {"role": "user", "content": "Hello!"},
             ]
 
-        messages = preprocess_messages_for_llm(messages)
+        messages = self._preprocessor(messages)
         return messages
 
     def set_instructions(self, instructions: Instructions):
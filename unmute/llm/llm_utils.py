@@ -1,79 +1,320 @@
+import asyncio
+import hashlib
+import json
 import os
 import re
-from copy import deepcopy
-from functools import cache
-from typing import Any, AsyncIterator, Protocol, cast
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Protocol, TypeVar, cast
 
 from mistralai import Mistral
+from mistralai.models import ChatCompletionStreamRequestMessagesTypedDict
 from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletionMessageParam
+from openai.types.chat.chat_completion_chunk import (
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
 from openai.types.chat.chat_completion_message_tool_call import (
     ChatCompletionMessageToolCall,
     Function,
 )
+from openai.types.model import Model
 
 from unmute.kyutai_constants import LLM_SERVER
 
-from ..kyutai_constants import KYUTAI_LLM_MODEL
+from ..kyutai_constants import KYUTAI_LLM_MODEL, KYUTAI_LLM_MODEL_SELECTOR
+
+T = TypeVar("T")
 
 INTERRUPTION_CHAR = "—"  # em-dash
 USER_SILENCE_MARKER = "..."
 
+_SPACE_RE = re.compile(r"\s+")
 
-def preprocess_messages_for_llm(
-    chat_history: list[dict[str, Any]],
-) -> list[dict[str, Any]]:
-    output = []
 
-    for message in chat_history:
-        message = deepcopy(message)
-
-        # Sometimes, an interruption happens before the LLM can say anything at all.
-        # In that case, we're left with a message with only INTERRUPTION_CHAR.
-        # Simplify by removing.
-        if (
-            isinstance(message.get("content"), str)
-            and message["content"].replace(INTERRUPTION_CHAR, "") == ""
-        ):
-            continue
+def _clean_message(message: dict[str, Any]) -> bool:
+    """Modify `message` in place if needed, return False if it should be dropped."""
+    content = message.get("content")
 
-        if (
-            output
-            and message["role"] == output[-1]["role"]
-            and isinstance(message.get("content"), str)
-            and isinstance(output[-1].get("content"), str)
-            and message.get("tool_calls") is None
-            and output[-1].get("tool_calls") is None
-        ):
-            output[-1]["content"] += " " + message["content"]
-        else:
-            output.append(message)
+    if (
+        message["role"] == "user"
+        and isinstance(content, str)
+        and content.startswith(USER_SILENCE_MARKER)
+        and content != USER_SILENCE_MARKER
+    ):
+        # This happens when the user is silent but then starts talking again after
+        # the silence marker was inserted but before the LLM could respond.
+        # There are special instructions in the system prompt about how to handle
+        # the silence marker, so remove the marker from the message to not confuse
+        # the LLM
+        content = content[len(USER_SILENCE_MARKER) :]
+        message["content"] = content
+
+    # Sometimes, an interruption happens before the LLM can say anything at all.
+    # In that case, we're left with a message with only INTERRUPTION_CHAR.
+    # Simplify by removing. Empty messages are removed too.
+    return not (isinstance(content, str) and not content.strip(INTERRUPTION_CHAR))
+
+
+def _merge_info(message: dict[str, Any]) -> tuple[str, bool]:
+    """The role of the message and whether it can be merged with.
+
+    Messages can be merged if they have string content and no tool calls.
+    """
+    return message["role"], (
+        isinstance(message.get("content"), str) and message.get("tool_calls") is None
+    )
+
+
+def _merge_message(
+    output: list[dict[str, Any]],
+    output_info: list[tuple[str, bool]],
+    message: dict[str, Any],
+):
+    """Add `message` to `output`, merging it into the last message if possible.
 
+    `output_info` is kept in sync with `output`, see [_merge_info].
+    """
+    # Shallow copy: we only ever replace top-level values, never mutate nested ones
+    message = dict(message)
+    if not _clean_message(message):
+        return
+
+    info = _merge_info(message)
+    if info[1] and output_info and output_info[-1] == info:
+        output[-1]["content"] += " " + message["content"]
+    else:
+        output.append(message)
+        output_info.append(info)
+
+
+def _needs_dummy_user_message(output: list[dict[str, Any]]) -> bool:
     def role_at(index: int) -> str | None:
         if index >= len(output):
             return None
         return output[index]["role"]
 
-    if role_at(0) == "system" and role_at(1) in [None, "assistant"]:
-        # Some LLMs, like Gemma, get confused if the assistant message goes before user
-        # messages, so add a dummy user message.
-        output = [output[0]] + [{"role": "user", "content": "Hello."}] + output[1:]
+    # Some LLMs, like Gemma, get confused if the assistant message goes before user
+    # messages, so add a dummy user message.
+    return role_at(0) == "system" and role_at(1) in [None, "assistant"]
+
+
+# Shared between calls, so it must not be modified
+_DUMMY_USER_MESSAGE = {"role": "user", "content": "Hello."}
+
+
+def _add_dummy_user_message(output: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    if _needs_dummy_user_message(output):
+        return [output[0], _DUMMY_USER_MESSAGE, *output[1:]]
+
+    return list(output)
 
+
+def _is_already_preprocessed(chat_history: list[dict[str, Any]]) -> bool:
+    """Check that preprocessing would leave every message as it is.
+
+    Conservative: may return False for histories that wouldn't actually change.
+    """
+    previous_role = None
     for message in chat_history:
-        if (
-            message["role"] == "user"
-            and isinstance(message.get("content"), str)
-            and message["content"].startswith(USER_SILENCE_MARKER)
-            and message["content"] != USER_SILENCE_MARKER
+        role = message["role"]
+        content = message.get("content")
+        if role == previous_role:
+            return False
+        if isinstance(content, str) and (
+            content == ""
+            or INTERRUPTION_CHAR in content
+            or content.startswith(USER_SILENCE_MARKER)
         ):
-            # This happens when the user is silent but then starts talking again after
-            # the silence marker was inserted but before the LLM could respond.
-            # There are special instructions in the system prompt about how to handle
-            # the silence marker, so remove the marker from the message to not confuse
-            # the LLM
-            message["content"] = message["content"][len(USER_SILENCE_MARKER) :]
+            return False
+        previous_role = role
+    return True
+
+
+def preprocess_messages_for_llm_inplace(
+    chat_history: list[dict[str, Any]],
+) -> list[dict[str, Any]]:
+    """Same as [preprocess_messages_for_llm], but without copying anything.
+
+    The list and the messages in it are modified in place, so don't reuse them.
+    Returns `chat_history` itself.
+    """
+    output_info: list[tuple[str, bool]] = []
+    n_output = 0
+
+    # Writing at `n_output` is safe because it never goes past the message being read
+    for message in chat_history:
+        if not _clean_message(message):
+            continue
+
+        info = _merge_info(message)
+        if info[1] and output_info and output_info[-1] == info:
+            chat_history[n_output - 1]["content"] += " " + message["content"]
+        else:
+            chat_history[n_output] = message
+            n_output += 1
+            output_info.append(info)
+
+    del chat_history[n_output:]
+
+    if _needs_dummy_user_message(chat_history):
+        # A copy, because the caller may modify the messages of the output
+        chat_history.insert(1, dict(_DUMMY_USER_MESSAGE))
+
+    return chat_history
+
+
+def _estimate_tokens(message: dict[str, Any]) -> int:
+    """Rough token count of a message, assuming ~4 characters per token."""
+    n_chars = len(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        n_chars += len(tool_call.get("function", {}).get("arguments") or "")
+    return n_chars // 4
+
+
+def _truncate_to_token_budget(
+    messages: list[dict[str, Any]], max_tokens: int
+) -> list[dict[str, Any]]:
+    """Drop the oldest messages, except system ones, to fit in `max_tokens`.
+
+    The number of tokens to drop is rounded up to a power-of-two bucket, so that the
+    start of the conversation doesn't change on every turn. Otherwise, the LLM
+    server would never be able to reuse its prefix cache once the history is long.
+    The last message is always kept.
+    """
+    sizes = [_estimate_tokens(m) for m in messages]
+    n_over = sum(sizes) - max_tokens
+    if n_over <= 0:
+        return messages
+
+    bucket = 1 << (max(max_tokens // 2, 1).bit_length() - 1)
+    n_to_drop = -(-n_over // bucket) * bucket  # Round up to a multiple of `bucket`
+
+    n_system = 0
+    while n_system < len(messages) and messages[n_system]["role"] == "system":
+        n_system += 1
+
+    start = n_system
+    n_dropped = 0
+    while start < len(messages) - 1 and n_dropped < n_to_drop:
+        n_dropped += sizes[start]
+        start += 1
+    # Tool results don't make sense without the tool call that they answer, so keep
+    # the assistant message with the `tool_calls` too, even if it's over budget.
+    while start > n_system and messages[start]["role"] == "tool":
+        start -= 1
+
+    return messages[:n_system] + messages[start:]
+
+
+def preprocess_messages_for_llm(
+    chat_history: list[dict[str, Any]],
+    max_tokens_hint: int | None = None,
+) -> list[dict[str, Any]]:
+    """Clean up the chat history before sending it to the LLM.
+
+    If `max_tokens_hint` is given, the oldest messages are dropped to keep the
+    estimated length of the conversation under it, see [_truncate_to_token_budget].
+    """
+    if _is_already_preprocessed(chat_history):
+        # Common case, no need to copy anything. Note that the output then shares the
+        # message dicts with `chat_history`.
+        output = _add_dummy_user_message(chat_history)
+    else:
+        output = preprocess_messages_for_llm_inplace([dict(m) for m in chat_history])
+
+    if max_tokens_hint is not None:
+        output = _truncate_to_token_budget(output, max_tokens_hint)
+        # Truncation might have removed the dummy user message or the real first one
+        output = _add_dummy_user_message(output)
 
     return output
 
+
+@dataclass(slots=True)
+class _Checkpoint:
+    """The state of [IncrementalPreprocessor] after processing one input message."""
+
+    # The input message and its values at the time, to detect changes
+    message: dict[str, Any]
+    role: Any
+    content: Any
+    tool_calls: Any
+    # Length of the output after processing the message
+    output_len: int
+    # Content of the last output message at that point. Later messages may still be
+    # merged into it, so it's the only thing that can change afterwards.
+    last_content: Any
+
+
+class IncrementalPreprocessor:
+    """Same as [preprocess_messages_for_llm], but reuses the work of the previous call.
+
+    Meant to be called repeatedly on a chat history that mostly grows at the end.
+    Messages that are the same objects with the same role, content and tool calls
+    (compared by identity, so `message["content"] += ...` is detected) as in the
+    previous call aren't processed again.
+    """
+
+    def __init__(self, max_tokens_hint: int | None = None):
+        self.max_tokens_hint = max_tokens_hint
+        self._checkpoints: list[_Checkpoint] = []
+        self._output: list[dict[str, Any]] = []
+        self._output_info: list[tuple[str, bool]] = []
+
+    def __call__(self, chat_history: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        n_reused = 0
+        n_max = min(len(self._checkpoints), len(chat_history))
+        while n_reused < n_max:
+            checkpoint = self._checkpoints[n_reused]
+            current = chat_history[n_reused]
+            if (
+                current is not checkpoint.message
+                or current.get("role") is not checkpoint.role
+                or current.get("content") is not checkpoint.content
+                or current.get("tool_calls") is not checkpoint.tool_calls
+            ):
+                break
+            n_reused += 1
+
+        if n_reused == 0:
+            output = []
+            output_info = []
+        else:
+            checkpoint = self._checkpoints[n_reused - 1]
+            output = self._output[: checkpoint.output_len]
+            output_info = self._output_info[: checkpoint.output_len]
+            if output and output_info[-1][1]:
+                # Undo what was merged into it after the checkpoint
+                output[-1] = {**output[-1], "content": checkpoint.last_content}
+
+        del self._checkpoints[n_reused:]
+        for message in chat_history[n_reused:]:
+            _merge_message(output, output_info, message)
+            self._checkpoints.append(
+                _Checkpoint(
+                    message=message,
+                    role=message.get("role"),
+                    content=message.get("content"),
+                    tool_calls=message.get("tool_calls"),
+                    output_len=len(output),
+                    last_content=output[-1].get("content") if output else None,
+                )
+            )
+
+        self._output = output
+        self._output_info = output_info
+
+        result = _add_dummy_user_message(output)
+        if self.max_tokens_hint is not None:
+            result = _truncate_to_token_budget(result, self.max_tokens_hint)
+            result = _add_dummy_user_message(result)
+        return result
+
+
 async def rechunk_to_words(iterator: AsyncIterator[str]) -> AsyncIterator[str]:
     """Rechunk the stream of text to whole words.
 
@@ -84,23 +325,64 @@ async def rechunk_to_words(iterator: AsyncIterator[str]) -> AsyncIterator[str]:
     "foo", " bar", " baz".
     Multiple space-like characters will be merged to a single space.
     """
-    buffer = ""
-    space_re = re.compile(r"\s+")
+    # The unfinished word. If it's made of many deltas, they're collected in `parts`
+    # and only joined once the word is complete, to not copy it over and over.
+    pending = ""
+    parts: list[str] = []
     prefix = ""
     async for delta in iterator:
-        buffer = buffer + delta
-        while True:
-            match = space_re.search(buffer)
-            if match is None:
-                break
-            chunk = buffer[: match.start()]
-            buffer = buffer[match.end() :]
-            if chunk != "":
-                yield prefix + chunk
-            prefix = " "
+        match = _SPACE_RE.search(delta)
+        if match is None:
+            if pending:
+                parts.append(delta)
+            else:
+                pending = delta
+            continue
+
+        start = match.start()
+        if parts:
+            parts.append(delta[:start])
+            chunk = pending + "".join(parts)
+            parts.clear()
+        else:
+            chunk = pending + delta[:start] if start else pending
+        if chunk != "":
+            yield prefix + chunk
+        prefix = " "
+
+        pos = match.end()
+        while (match := _SPACE_RE.search(delta, pos)) is not None:
+            yield prefix + delta[pos : match.start()]
+            pos = match.end()
+        pending = delta[pos:]
+
+    rest = pending + "".join(parts)
+    if rest != "":
+        yield prefix + rest
+
+
+@dataclass(slots=True)
+class _ToolCallAccumulator:
+    """A tool call that is still being streamed.
+
+    Cheaper to update than the Pydantic ChatCompletionMessageToolCall, which is only
+    built once the tool call is complete.
+    """
+
+    id: str = ""
+    name: str = ""
+    arguments: str = ""
+
 
-    if buffer != "":
-        yield prefix + buffer
+def _finish_tool_call(
+    tool: _ToolCallAccumulator | None,
+) -> ChatCompletionMessageToolCall:
+    assert tool is not None
+    return ChatCompletionMessageToolCall(
+        id=tool.id,
+        function=Function(name=tool.name, arguments=tool.arguments),
+        type="function",
+    )
 
 
 async def rechunk_to_words_and_functions(
@@ -112,11 +394,17 @@ async def rechunk_to_words_and_functions(
 
     Words are yielded as {"word": "word"}.
     Tool calls are yielded as {"function": {"id": "...", "name": "...", "arguments": "..."}}.
+    A tool call is only yielded once it's complete, i.e. when the LLM moves on to
+    another tool call or to text, or when the stream ends.
     """
-    buffer = ""
-    space_re = re.compile(r"\s+")
+    # See [rechunk_to_words]
+    pending = ""
+    parts: list[str] = []
     prefix = ""
-    tools: dict[int, ChatCompletionMessageToolCall] = {}
+    # Indexed by the tool call index, which counts up from 0
+    tools: list[_ToolCallAccumulator | None] = []
+    # Tool calls that are still being streamed and haven't been yielded yet
+    pending_tool_indices: set[int] = set()
 
     async for delta in iterator:
         if not delta:
@@ -124,41 +412,98 @@ async def rechunk_to_words_and_functions(
         if delta.tool_calls:
             for tool_call_chunk in delta.tool_calls:
                 index = tool_call_chunk.index
-                if index not in tools:
-                    tools[index] = ChatCompletionMessageToolCall(
-                        id=tool_call_chunk.id or "",
-                        function=Function(
-                            name=tool_call_chunk.function.name or "",
-                            arguments=tool_call_chunk.function.arguments or "",
-                        ),
-                        type="function",
-                    )
-                else:
-                    tool = tools[index]
-                    if tool_call_chunk.id:
-                        tool.id = tool_call_chunk.id
-                    if tool_call_chunk.function:
-                        if tool_call_chunk.function.name:
-                            tool.function.name = tool_call_chunk.function.name
-                        if tool_call_chunk.function.arguments:
-                            tool.function.arguments += (
-                                tool_call_chunk.function.arguments
-                            )
-                yield {"function": tools[index]}
+                for finished_index in sorted(pending_tool_indices - {index}):
+                    pending_tool_indices.remove(finished_index)
+                    yield {"function": _finish_tool_call(tools[finished_index])}
+
+                while len(tools) <= index:
+                    tools.append(None)
+
+                tool = tools[index]
+                if tool is None:
+                    tool = tools[index] = _ToolCallAccumulator()
+                if tool_call_chunk.id:
+                    tool.id = tool_call_chunk.id
+                if tool_call_chunk.function:
+                    if tool_call_chunk.function.name:
+                        tool.name = tool_call_chunk.function.name
+                    if tool_call_chunk.function.arguments:
+                        tool.arguments += tool_call_chunk.function.arguments
+                pending_tool_indices.add(index)
         if delta.content:
-            buffer = buffer + delta.content
-            while True:
-                match = space_re.search(buffer)
-                if match is None:
-                    break
-                chunk = buffer[: match.start()]
-                buffer = buffer[match.end() :]
-                if chunk != "":
-                    yield {"word": prefix + chunk}
-                prefix = " "
+            for finished_index in sorted(pending_tool_indices):
+                yield {"function": _finish_tool_call(tools[finished_index])}
+            pending_tool_indices.clear()
+
+            text = delta.content
+            match = _SPACE_RE.search(text)
+            if match is None:
+                if pending:
+                    parts.append(text)
+                else:
+                    pending = text
+                continue
+
+            start = match.start()
+            if parts:
+                parts.append(text[:start])
+                chunk = pending + "".join(parts)
+                parts.clear()
+            else:
+                chunk = pending + text[:start] if start else pending
+            if chunk != "":
+                yield {"word": prefix + chunk}
+            prefix = " "
+
+            pos = match.end()
+            while (match := _SPACE_RE.search(text, pos)) is not None:
+                yield {"word": prefix + text[pos : match.start()]}
+                pos = match.end()
+            pending = text[pos:]
+
+    for finished_index in sorted(pending_tool_indices):
+        yield {"function": _finish_tool_call(tools[finished_index])}
+
+    rest = pending + "".join(parts)
+    if rest != "":
+        yield {"word": prefix + rest}
 
-    if buffer != "":
-        yield {"word": prefix + buffer}
+
+@dataclass
+class _EndOfStream:
+    error: Exception | None = None
+
+
+async def _prefetch(iterator: AsyncIterator[T], maxsize: int = 8) -> AsyncIterator[T]:
+    """Consume `iterator` in a background task and yield its items.
+
+    This way, the next items can be received from the network while the caller is
+    still processing the previous ones. At most `maxsize` items are buffered, after
+    which the background task waits for the caller to catch up.
+    """
+    queue: asyncio.Queue[Any] = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
+        try:
+            async for item in iterator:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(_EndOfStream(e))
+        else:
+            await queue.put(_EndOfStream())
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if isinstance(item, _EndOfStream):
+                if item.error is not None:
+                    raise item.error
+                break
+            yield item
+    finally:
+        # If the caller stopped early, e.g. because of an interruption
+        task.cancel()
 
 
 class LLMStream(Protocol):
@@ -187,27 +532,186 @@ class MistralStream:
             raise NotImplementedError("MistralStream does not support tool calling yet.")
         event_stream = await self.mistral.chat.stream_async(
             model="mistral-large-latest",
-            messages=cast(Any, messages),  # It's too annoying to type this properly
+            messages=cast(list[ChatCompletionStreamRequestMessagesTypedDict], messages),
             temperature=1.0,
         )
 
-        async for event in event_stream:
-            yield event.data.choices[0].delta
+        async def deltas():
+            async for event in event_stream:
+                yield event.data.choices[0].delta
+
+        async for delta in _prefetch(deltas()):
+            yield delta
 
 
 def get_openai_client(server_url: str = LLM_SERVER) -> AsyncOpenAI:
     return AsyncOpenAI(api_key="EMPTY", base_url=server_url + "/v1")
 
 
-@cache
-def autoselect_model() -> str:
+# Model names by base URL of the LLM server, without trailing slash. Set by whichever
+# of autoselect_model() or autoselect_model_async() runs first for that server.
+_MODEL_CACHE: dict[str, str] = {}
+
+
+def _select_model(models: list[Model], selector: str) -> str:
+    if not models:
+        raise ValueError("No models available.")
+
+    if selector == "oldest":
+        return min(models, key=lambda m: (m.created or 0, m.id)).id
+    elif selector == "newest":
+        return max(models, key=lambda m: (m.created or 0, m.id)).id
+    elif selector == "alphabetical":
+        return min(m.id for m in models)
+    else:
+        raise ValueError(f"Unknown model selector: {selector!r}")
+
+
+def get_selected_model(server_url: str = LLM_SERVER) -> str | None:
+    """Return the model picked by [autoselect_model_async], or None if not known yet.
+
+    Unlike [autoselect_model], this never contacts the LLM server.
+    """
+    if KYUTAI_LLM_MODEL is not None:
+        return KYUTAI_LLM_MODEL
+    return _MODEL_CACHE.get(server_url + "/v1")
+
+
+def autoselect_model(server_url: str = LLM_SERVER) -> str:
+    """Blocking version of [autoselect_model_async].
+
+    Nothing in the server uses it, since it would block the event loop. It's only a
+    fallback for scripts that run outside of it.
+    """
+    if KYUTAI_LLM_MODEL is not None:
+        return KYUTAI_LLM_MODEL
+
+    # Same as the base URL of [get_openai_client]
+    base_url = server_url + "/v1"
+    if base_url not in _MODEL_CACHE:
+        client_sync = OpenAI(api_key="EMPTY", base_url=base_url)
+        models = client_sync.models.list()
+        _MODEL_CACHE[base_url] = _select_model(models.data, KYUTAI_LLM_MODEL_SELECTOR)
+    return _MODEL_CACHE[base_url]
+
+
+async def autoselect_model_async(client: AsyncOpenAI | None = None) -> str:
+    """Return KYUTAI_LLM_MODEL, or pick one of the models served by the LLM server.
+
+    If the server has several models, KYUTAI_LLM_MODEL_SELECTOR decides which one.
+    """
     if KYUTAI_LLM_MODEL is not None:
         return KYUTAI_LLM_MODEL
-    client_sync = OpenAI(api_key="EMPTY", base_url=get_openai_client().base_url)
-    models = client_sync.models.list()
-    if len(models.data) != 1:
-        raise ValueError("There are multiple models available. Please specify one.")
-    return models.data[0].id
+
+    client = client or get_openai_client()
+    # The OpenAI client adds a trailing slash to the URL it was given
+    base_url = str(client.base_url).rstrip("/")
+    if base_url not in _MODEL_CACHE:
+        models = await client.models.list()
+        _MODEL_CACHE[base_url] = _select_model(models.data, KYUTAI_LLM_MODEL_SELECTOR)
+    return _MODEL_CACHE[base_url]
+
+
+# Tool call fragment of a cached delta: (index, id, name, arguments)
+_CachedToolCall = tuple[int, str | None, str | None, str | None]
+# A cached delta: just its content, or (content, tool call fragments)
+_CachedDelta = str | tuple[str | None, tuple[_CachedToolCall, ...]]
+
+
+class LLMResponseCache:
+    """In-memory LRU cache of streamed LLM responses, keyed on the whole request.
+
+    Only exact matches are served: same model, sampling parameters, messages and
+    tools. Responses are stored as plain strings and tuples rather than as the
+    deltas themselves, which take hundreds of bytes each, and the deltas are rebuilt
+    on replay. The least recently used entries are evicted to stay under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, replay_delay_sec: float = 0.0):
+        self.max_bytes = max_bytes
+        # Wait between replayed deltas, to not send a whole response at once
+        self.replay_delay_sec = replay_delay_sec
+        self.entries: OrderedDict[str, tuple[list[_CachedDelta], int]] = OrderedDict()
+        self.n_bytes = 0
+
+    @staticmethod
+    def make_key(create_kwargs: dict[str, Any]) -> str:
+        serialized = json.dumps(create_kwargs, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get(self, key: str) -> list[_CachedDelta] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: str, deltas: list[Any]):
+        # Deltas without content or tool calls, e.g. the one giving the role, are
+        # ignored by the consumers so they are not stored.
+        cached = [c for c in map(_compact_delta, deltas) if c is not None]
+        size = _cached_size(cached)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (cached, size)
+        self.n_bytes += size
+
+        while self.n_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_size
+
+    async def replay(self, cached: list[_CachedDelta]) -> AsyncIterator[ChoiceDelta]:
+        for item in cached:
+            yield _expand_delta(item)
+            if self.replay_delay_sec > 0:
+                await asyncio.sleep(self.replay_delay_sec)
+
+
+def _compact_delta(delta: Any) -> _CachedDelta | None:
+    content = getattr(delta, "content", None)
+    tool_calls = getattr(delta, "tool_calls", None)
+    if not tool_calls:
+        return content
+    return (
+        content,
+        tuple(
+            (
+                t.index,
+                t.id,
+                t.function.name if t.function else None,
+                t.function.arguments if t.function else None,
+            )
+            for t in tool_calls
+        ),
+    )
+
+
+def _expand_delta(item: _CachedDelta) -> ChoiceDelta:
+    if isinstance(item, str):
+        return ChoiceDelta(content=item)
+    content, tool_calls = item
+    return ChoiceDelta(
+        content=content,
+        tool_calls=[
+            ChoiceDeltaToolCall(
+                index=index,
+                id=id,
+                function=ChoiceDeltaToolCallFunction(name=name, arguments=arguments),
+            )
+            for index, id, name, arguments in tool_calls
+        ],
+    )
+
+
+def _cached_size(obj: Any) -> int:
+    """Memory used by `obj` in bytes, including what its lists and tuples contain."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_cached_size(x) for x in cast(list[Any], obj))
+    return size
 
 
 class VLLMStream:
@@ -216,15 +720,22 @@ class VLLMStream:
         client: AsyncOpenAI,
         temperature: float = 1.0,
         extra_body: dict[str, Any] | None = None,
+        model: str | None = None,
+        response_cache: LLMResponseCache | None = None,
     ):
         """
-        If `model` is None, it will look at the available models, and if there is only
-        one model, it will use that one. Otherwise, it will raise.
+        If `model` is None, it will look at the available models and pick one, see
+        [autoselect_model_async]. The lookup happens on the first call to
+        `chat_completion`, not here, to not block the event loop.
+
+        If `response_cache` is given, identical requests are answered from the cache
+        instead of by the LLM.
         """
         self.client = client
-        self.model = autoselect_model()
+        self.model = model
         self.temperature = temperature
         self.extra_body = extra_body or {}
+        self.response_cache = response_cache
 
     async def chat_completion(
         self,
@@ -232,9 +743,12 @@ class VLLMStream:
         tools: list[dict[str, Any]] | None = None,
         tool_choice: str | None = None,
     ) -> AsyncIterator[Any]:
+        if self.model is None:
+            self.model = await autoselect_model_async(self.client)
+
         create_kwargs: dict[str, Any] = {
             "model": self.model,
-            "messages": cast(Any, messages),  # Cast and hope for the best
+            "messages": cast(list[ChatCompletionMessageParam], messages),
             "stream": True,
             "temperature": self.temperature,
             "extra_body": self.extra_body,
@@ -244,8 +758,31 @@ class VLLMStream:
         if tool_choice:
             create_kwargs["tool_choice"] = tool_choice
 
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(create_kwargs)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                async for delta in self.response_cache.replay(cached):
+                    yield delta
+                return
+
         stream = await self.client.chat.completions.create(**create_kwargs)
 
-        async with stream:
-            async for chunk in stream:
-                yield chunk.choices[0].delta
+        async def deltas():
+            async with stream:
+                async for chunk in stream:
+                    yield chunk.choices[0].delta
+
+        if self.response_cache is None or cache_key is None:
+            async for delta in _prefetch(deltas()):
+                yield delta
+            return
+
+        recorded = []
+        async for delta in _prefetch(deltas()):
+            recorded.append(delta)
+            yield delta
+
+        # Only reached if the whole response was consumed, not on interruptions
+        self.response_cache.set(cache_key, recorded)
@@ -5,7 +5,7 @@ from typing import Annotated, Literal, Union
 
 from pydantic import BaseModel, Field
 
-from unmute.llm.llm_utils import autoselect_model
+from unmute.llm.llm_utils import get_selected_model
 from unmute.llm.newsapi import get_news
 from unmute.llm.quiz_show_questions import QUIZ_SHOW_QUESTIONS
 
@@ -90,7 +90,11 @@ LANGUAGE_CODE_TO_INSTRUCTIONS: dict[LanguageCode | None, str] = {
 
 
 def get_readable_llm_name():
-    model = autoselect_model()
+    # Don't block the event loop asking the LLM server: the model is looked up at
+    # startup, see prewarm_llm_model() in main_websocket.py.
+    model = get_selected_model()
+    if model is None:
+        return "unknown"
     return model.replace("-", " ").replace("_", " ")
 
 CONSTANT_INSTRUCTIONS = """
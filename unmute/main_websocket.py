@@ -3,6 +3,7 @@ import asyncio
 import base64
 import json
 import logging
+from contextlib import asynccontextmanager
 from functools import cache, partial
 from typing import Annotated
 
@@ -46,6 +47,7 @@ from unmute.kyutai_constants import (
     TTS_SERVER,
     VOICE_CLONING_SERVER,
 )
+from unmute.llm.llm_utils import autoselect_model_async
 from unmute.service_discovery import async_ttl_cached
 from unmute.timer import Stopwatch
 from unmute.tts.voice_cloning import clone_voice
@@ -57,7 +59,32 @@ from unmute.tts.voice_donation import (
 from unmute.tts.voices import VoiceList
 from unmute.unmute_handler import UnmuteHandler
 
-app = FastAPI()
+
+async def prewarm_llm_model():
+    # Look up the LLM model now so that sessions don't have to wait for it later, and
+    # so that system prompts can name it. Retry, the LLM server might still be starting.
+    delay = 1.0
+    while True:
+        try:
+            model = await autoselect_model_async()
+            logger.info(f"Using LLM model {model}")
+            return
+        except Exception as e:
+            logger.warning(
+                f"Could not determine the LLM model, retrying in {delay:.0f}s: {e}"
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    prewarm_task = asyncio.create_task(prewarm_llm_model())
+    yield
+    prewarm_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
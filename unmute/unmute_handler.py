@@ -22,6 +22,7 @@ from unmute.audio_input_override import AudioInputOverride
 from unmute.exceptions import make_ora_error
 from unmute.kyutai_constants import (
     FRAME_TIME_SEC,
+    LLM_RESPONSE_CACHE_MB,
     RECORDINGS_DIR,
     SAMPLE_RATE,
     SAMPLES_PER_FRAME,
@@ -30,6 +31,7 @@ from unmute.llm.chatbot import Chatbot
 from unmute.llm.llm_utils import (
     INTERRUPTION_CHAR,
     USER_SILENCE_MARKER,
+    LLMResponseCache,
     VLLMStream,
     get_openai_client,
     rechunk_to_words_and_functions,
@@ -81,6 +83,18 @@ LLM_EXTRA_BODY = {
 #     "chat_template_kwargs": {"enable_thinking": False},
 # }
 
+# Shared between sessions, but the system prompt contains the time at which the
+# session's instructions were set, to the minute. So in practice, entries are mostly
+# hit within a session, or by sessions started in the same minute.
+LLM_RESPONSE_CACHE = (
+    LLMResponseCache(
+        max_bytes=int(LLM_RESPONSE_CACHE_MB * 1024 * 1024),
+        replay_delay_sec=0.01,
+    )
+    if LLM_RESPONSE_CACHE_MB > 0
+    else None
+)
+
 # For this much time, the VAD does not interrupt the bot. This is needed because at
 # least on Mac, the echo cancellation takes a while to kick in, at the start, so the ASR
 # sometimes hears a bit of the TTS audio and interrupts the bot. Only happens on the
@@ -229,6 +243,7 @@ class UnmuteHandler(AsyncStreamHandler):
             if generating_message_i == 2
             else FURTHER_MESSAGES_TEMPERATURE,
             extra_body=LLM_EXTRA_BODY,
+            response_cache=LLM_RESPONSE_CACHE,
         )
 
         messages = self.chatbot.preprocessed_messages()